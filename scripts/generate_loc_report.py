@@ -6,12 +6,26 @@
 """
 
 import argparse
+import hashlib
 import json
+import os
 import subprocess
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from typing import Dict, Tuple, List
 
 DEFAULT_EXCLUDES = ["target", ".git", "arceos/target", "build", "dist"]
+CACHE_FILE = ".loc_cache.json"
+CACHE_VERSION = 2  # 缓存格式或统计口径变化时递增，使旧缓存整体失效
+MD_EMPTY = "_无数据_"
+MD_HEADER = "| 语言 | LOC | 占比 |\n|------|------:|------:|"
+MD_ROW_TEMPLATE = "| {} | {:,} | {:.2f}% |"
+MD_ROW = MD_ROW_TEMPLATE.format
+# 缓存的渲染结果以表格格式为键，修改上述模板后旧表格自动失效
+RENDER_VERSION = hashlib.blake2b(
+    "\0".join((MD_EMPTY, MD_HEADER, MD_ROW_TEMPLATE)).encode("utf-8"), digest_size=8
+).hexdigest()
 
 # --------------------------
 # 参数解析
@@ -30,6 +44,12 @@ def parse_args():
     )
 
     parser.add_argument("--top", type=int, default=100, help="Top-N languages per repo (default: 100)")
+    parser.add_argument(
+        "--keep-raw",
+        action="store_true",
+        help="Keep full tokei output (per-file stats) in loc.json; by default only errors are kept",
+    )
+    parser.add_argument("--no-cache", action="store_true", help=f"Ignore <output>/{CACHE_FILE} and rescan every repo")
 
     return parser.parse_args()
 
@@ -37,18 +57,103 @@ def parse_args():
 # --------------------------
 # 调用 tokei
 # --------------------------
-def run_tokei(path: Path, excludes: List[str] = None) -> Dict:
+def run_tokei(path: Path, excludes: List[str] = None, num_threads: int = 0) -> Dict:
     excludes = (excludes or []) + DEFAULT_EXCLUDES
     try:
-        cmd = ["tokei", path.as_posix(), "--output", "json"]
+        # tokei 的 --exclude 以其 cwd 为根（含 "/" 的模式锚定到根），因此在 repo 目录内扫描 "."，
+        # 使 "third_party/packages"、"arceos/target" 这类相对路径按 repo 根匹配
+        cmd = ["tokei", ".", "--output", "json"]
         for ex in excludes:
             cmd.extend(["--exclude", ex])
-        out = subprocess.check_output(cmd, stderr=subprocess.DEVNULL)
+        # 多个 tokei 并发时按实例平分核数（tokei 的 rayon 线程池读取 RAYON_NUM_THREADS），
+        # 避免各自按全部核数超额开线程
+        env = {**os.environ, "RAYON_NUM_THREADS": str(num_threads)} if num_threads > 0 else None
+        # check=True 先于解析检查退出码，tokei 失败时报告 CalledProcessError 而不是空输出的 JSON 错误
+        out = subprocess.run(
+            cmd, cwd=path, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, env=env, check=True
+        ).stdout
         return json.loads(out)
     except Exception as e:
         return {"error": str(e)}
 
 
+def excluded_leaks(raw: Dict, exclude: str) -> List[str]:
+    """返回 tokei 逐文件统计中仍落在 exclude 子树下的文件，用于确认排除确实生效。"""
+    prefix = Path(exclude).parts
+    leaks = []
+    for lang in raw.values():
+        if not isinstance(lang, dict):
+            continue
+        for report in lang.get("reports", []):
+            # tokei 在 "." 上扫描，文件名形如 "./third_party/packages/x.rs"
+            if Path(report.get("name", "")).parts[: len(prefix)] == prefix:
+                leaks.append(report["name"])
+    return leaks
+
+
+# --------------------------
+# 扫描结果缓存
+# --------------------------
+def tokei_version() -> str:
+    try:
+        return subprocess.run(["tokei", "--version"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def git_clean_head(repo: Path, excludes: List[str]) -> str:
+    """repo 为独立 git 仓库且工作区干净时返回 HEAD 的 commit sha，否则返回空串。
+
+    git 会解析 packed-refs 等各种引用形式；未提交的修改、未跟踪文件都会让 status 非空。
+    """
+    # --no-optional-locks：只读统计不应顺带刷新被扫描仓库的 .git/index
+    git = ["git", "--no-optional-locks", "-C", repo.as_posix()]
+    try:
+        out = subprocess.run(
+            git + ["rev-parse", "--show-toplevel", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.splitlines()
+        # 位于上层仓库中的普通目录会解析到上层仓库，不能使用
+        if len(out) != 2 or Path(out[0]).resolve() != repo.resolve():
+            return ""
+        pathspec = ["."] + [f":(exclude){ex}" for ex in excludes]
+        status = subprocess.run(
+            git + ["status", "--porcelain", "--untracked-files=all", "--", *pathspec],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+    return "" if status.strip() else out[1]
+
+
+def repo_fingerprint(repo: Path, excludes: List[str], tokei_ver: str) -> str:
+    """指纹：CACHE_VERSION + tokei 版本 + 实际生效的 excludes + git HEAD sha；返回空串表示该仓库不可缓存。
+
+    只有干净的 git 工作区才能由 HEAD 唯一确定内容，非 git 目录与有改动的工作区每次都重新扫描。
+    """
+    head = git_clean_head(repo, excludes)
+    if not head:
+        return ""
+    h = hashlib.blake2b(digest_size=16)
+    for part in (str(CACHE_VERSION), tokei_ver, "\0".join(excludes + DEFAULT_EXCLUDES), head):
+        h.update(part.encode("utf-8"))
+        h.update(b"\n")
+    return h.hexdigest()
+
+
+def load_cache(path: Path) -> Dict[str, Dict]:
+    try:
+        data = json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def save_cache(path: Path, cache: Dict[str, Dict]) -> None:
+    path.write_text(json.dumps(cache, ensure_ascii=False), encoding="utf-8")
+
+
 # --------------------------
 # 汇总统计
 # --------------------------
@@ -66,19 +171,22 @@ def summarize_langs(data: Dict) -> Tuple[int, Dict[str, int]]:
 
 
 # --------------------------
-# Markdown 表格生成
+# 语言排序（每仓库只排一次，供 Top 语言列与详细表格复用）
 # --------------------------
-def md_table(lang_totals: Dict[str, int], total: int, limit: int) -> str:
-    if not lang_totals or total == 0:
-        return "_无数据_"
+def sort_langs(langs: Dict[str, int]) -> List[Tuple[str, int]]:
+    return sorted(langs.items(), key=lambda kv: kv[1], reverse=True)
+
 
-    rows = []
-    for lang, loc in sorted(lang_totals.items(), key=lambda kv: kv[1], reverse=True)[:limit]:
-        pct = loc / total * 100
-        rows.append(f"| {lang} | {loc:,} | {pct:.2f}% |")
+# --------------------------
+# Markdown 表格生成
+# --------------------------
+def md_table(sorted_langs: List[Tuple[str, int]], total: int, limit: int) -> str:
+    """sorted_langs 需已按 LOC 降序排列（见 sort_langs）。"""
+    if not sorted_langs or total == 0:
+        return MD_EMPTY
 
-    header = "| 语言 | LOC | 占比 |\n|------|------:|------:|"
-    return "\n".join([header] + rows)
+    rows = [MD_ROW(lang, loc, loc / total * 100) for lang, loc in sorted_langs[:limit]]
+    return "\n".join((MD_HEADER, *rows))
 
 # --------------------------
 # 主逻辑
@@ -94,22 +202,28 @@ def main():
     # 需要统计的 repo 列表：主仓 + local_crates（clone_dir）下每个子目录
     repos: List[Path] = [workspace]
     if clone_dir.exists():
-        repos += sorted([p for p in clone_dir.iterdir() if p.is_dir()], key=lambda p: p.name.lower())
+        # DirEntry.is_dir() 复用 readdir 返回的类型信息，非符号链接无需逐个 stat
+        with os.scandir(clone_dir) as it:
+            repos += sorted((Path(e.path) for e in it if e.is_dir()), key=lambda p: p.name.lower())
 
     results = {}
 
-    # -------- 扫描仓库 --------
-    for repo in repos:
-        print(f"[tokei] scanning {repo}")
-        # 如果 repo 是 workspace 且 clone_dir 在其中，避免重复统计 local_crates
-        if repo == workspace and clone_dir.exists() and clone_dir.is_dir():
-            excludes = ["local_crates"]
-        else:
-            excludes = []
-        raw = run_tokei(repo, excludes=excludes)
-        total, langs = summarize_langs(raw)
-
-        results[repo.name] = {
+    # -------- 读取缓存 --------
+    cache_path = output_dir / CACHE_FILE
+    cache = {} if args.no_cache else load_cache(cache_path)
+    new_cache: Dict[str, Dict] = {}
+
+    # -------- 扫描仓库（并发）--------
+    # tokei 子进程以 I/O 为主，多仓库并发扫描，墙钟时间趋近于最慢的单仓库
+    scanned: Dict[str, Dict] = {}
+    sorted_langs: Dict[str, List[Tuple[str, int]]] = {}
+
+    def add_result(name: str, raw: Dict, total: int, langs: Dict[str, int]) -> None:
+        # 报告只用到 raw["error"]，默认丢弃体积最大的逐文件统计
+        if not args.keep_raw:
+            raw = {"error": raw["error"]} if "error" in raw else {}
+        sorted_langs[name] = sort_langs(langs)
+        scanned[name] = {
             "raw": raw,
             "summary": {
                 "total": total,
@@ -117,16 +231,88 @@ def main():
             },
         }
 
+    # clone_dir 位于 workspace 内时，扫描主仓需排除它（各子仓库单独统计），
+    # 用其相对路径而非固定的 "local_crates"，tokei 不会再进入该子树
+    workspace_excludes: List[str] = []
+    if clone_dir.is_dir():
+        ws_abs, clone_abs = workspace.resolve(), clone_dir.resolve()
+        if clone_abs != ws_abs and clone_abs.is_relative_to(ws_abs):
+            workspace_excludes = [clone_abs.relative_to(ws_abs).as_posix()]
+
+    # 指纹与缓存查询：git status 需遍历工作区，在线程池中并发执行
+    tokei_ver = tokei_version()
+
+    def lookup(repo: Path):
+        excludes = workspace_excludes if repo == workspace else []
+        fingerprint = repo_fingerprint(repo, excludes, tokei_ver)
+        hit = cache.get(repo.name)
+        if not (
+            fingerprint
+            and isinstance(hit, dict)
+            and hit.get("fingerprint") == fingerprint
+            and (hit.get("raw_kept") or not args.keep_raw)
+        ):
+            hit = None
+        return repo, excludes, fingerprint, hit
+
+    with ThreadPoolExecutor(max_workers=max(1, min(8, len(repos)))) as ex:
+        lookups = list(ex.map(lookup, repos))
+
+    to_scan = []
+    for repo, excludes, fingerprint, hit in lookups:
+        if hit is not None:
+            print(f"[tokei] cache hit {repo}")
+            add_result(repo.name, hit["raw"], hit["total"], hit["langs"])
+            new_cache[repo.name] = hit
+        else:
+            to_scan.append((repo, excludes, fingerprint))
+
+    # 按实际需要扫描的仓库数（排除缓存命中）确定并发数与每个 tokei 实例的线程数
+    cpu_count = os.cpu_count() or 4
+    max_workers = max(1, min(8, cpu_count, len(to_scan)))
+    tokei_threads = max(1, cpu_count // max_workers)
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        futures = {}
+        for repo, excludes, fingerprint in to_scan:
+            print(f"[tokei] scanning {repo}")
+            futures[ex.submit(run_tokei, repo, excludes, tokei_threads)] = (repo, fingerprint)
+
+        for fut in as_completed(futures):
+            repo, fingerprint = futures[fut]
+            raw = fut.result()
+            if repo == workspace:
+                for exclude in workspace_excludes:
+                    leaks = excluded_leaks(raw, exclude)
+                    if leaks:
+                        print(
+                            f"[tokei] WARNING: {len(leaks)} files under {exclude} "
+                            f"were counted in {repo}, e.g. {leaks[0]}"
+                        )
+            total, langs = summarize_langs(raw)
+            add_result(repo.name, raw, total, langs)
+            # 扫描失败不写缓存，下次重试
+            if fingerprint and "error" not in raw:
+                new_cache[repo.name] = {
+                    "fingerprint": fingerprint,
+                    "total": total,
+                    "langs": langs,
+                    "raw": raw if args.keep_raw else {},
+                    "raw_kept": args.keep_raw,
+                }
+
+    # 按原仓库顺序输出，保证 loc.json 稳定
+    for repo in repos:
+        results[repo.name] = scanned[repo.name]
+
     # -------- 写 loc.json --------
-    with open(output_dir / "loc.json", "w") as f:
-        json.dump(results, f, indent=2, ensure_ascii=False)
+    # 先整体序列化再一次性写入，避免 json.dump 逐 token 的小块 write
+    (output_dir / "loc.json").write_text(json.dumps(results, indent=2, ensure_ascii=False), encoding="utf-8")
 
     # -------- 全局汇总 --------
     total_all = sum(r["summary"]["total"] for r in results.values())
-    global_langs: Dict[str, int] = {}
+    global_langs: Counter = Counter()
     for item in results.values():
-        for lang, loc in item["summary"]["languages"].items():
-            global_langs[lang] = global_langs.get(lang, 0) + loc
+        global_langs.update(item["summary"]["languages"])
 
     # -------- repo 排序（按 LOC 降序）--------
     sorted_repos = sorted(results.items(), key=lambda kv: kv[1]["summary"]["total"], reverse=True)
@@ -141,7 +327,8 @@ def main():
 
     # 全局语言分布
     md_lines.append("## 全局语言分布（Top 10）")
-    md_lines.append(md_table(global_langs, total_all, limit=10))
+    # most_common(n) 走堆选取 Top-N，无需对全部语言排序
+    md_lines.append(md_table(global_langs.most_common(10), total_all, limit=10))
     md_lines.append("")
 
     # 仓库排行
@@ -151,11 +338,10 @@ def main():
 
     for name, entry in sorted_repos:
         total = entry["summary"]["total"]
-        langs = entry["summary"]["languages"]
         if total == 0:
             top_lang_desc = "-"
         else:
-            top_lang = sorted(langs.items(), key=lambda kv: kv[1], reverse=True)[:3]
+            top_lang = sorted_langs[name][:3]
             top_lang_desc = ", ".join([f"{k}({v*100/total:.1f}%)" for k, v in top_lang])
 
         md_lines.append(f"| {name} | {total:,} | {top_lang_desc} |")
@@ -171,12 +357,21 @@ def main():
             continue
 
         total = entry["summary"]["total"]
-        langs = entry["summary"]["languages"]
 
         md_lines.append(f"- 总 LOC：**{total:,} 行**")
         md_lines.append("")
         md_lines.append("### 语言分布")
-        md_lines.append(md_table(langs, total, limit=args.top))
+        # 指纹未变的仓库直接复用上次渲染好的表格
+        cached = new_cache.get(name)
+        render_key = f"{RENDER_VERSION}:{args.top}"
+        if cached is not None and cached.get("rendered_key") == render_key and "rendered_block" in cached:
+            table = cached["rendered_block"]
+        else:
+            table = md_table(sorted_langs[name], total, limit=args.top)
+            if cached is not None:
+                cached["rendered_block"] = table
+                cached["rendered_key"] = render_key
+        md_lines.append(table)
         md_lines.append("")
 
     final_md = "\n".join(md_lines)
@@ -187,6 +382,7 @@ def main():
         Path(args.comment_output).write_text(final_md, encoding="utf-8")
         print(f"[report] Generated {args.comment_output}")
 
+    save_cache(cache_path, new_cache)
     print("[report] Generated loc.json, loc.md")
 
 
@@ -1,54 +1,160 @@
 #!/usr/bin/env python3
 import argparse
 import codecs
+import functools
 import json
 import os
 import re
+import selectors
+import signal
 import socket
 import subprocess
 import sys
-import threading
 import time
 from pathlib import Path
+from typing import Optional, Tuple
 
 READY_MSG = "QEMU waiting for connection"
 PROMPT = "starry:~# "  # 注意末尾有空格
 EXIT_PATTERN = re.compile(r"__EXIT:(-?\d+)__")
+# 接收循环在 bytes 上匹配，避免每块都解码并重扫整个字符串
+PROMPT_BYTES = PROMPT.encode("utf-8")
+EXIT_PATTERN_BYTES = re.compile(rb"__EXIT:(-?\d+)__")
+EXIT_RESCAN = 32  # 新数据到达时回看的字节数，覆盖跨块的 __EXIT:<code>__
+RECV_SIZE = 64 * 1024
+SOCK_RCVBUF = 1 << 20
+POLL_INTERVAL = 0.5
+MIRROR_FLUSH_SIZE = 64 * 1024
+MIRROR_FLUSH_INTERVAL = 0.2
+CONNECT_BACKOFF = 0.1  # 重试间隔从 0.1s 指数增长，上限 CONNECT_BACKOFF_MAX
+CONNECT_BACKOFF_MAX = 1.0
+
+
+LOG_FILE = sys.stdout
 
 
 def log(msg: str) -> None:
-    print(f"[starry-ci] {msg}")
+    print(f"[starry-ci] {msg}", file=LOG_FILE)
+
+
+class StderrForwarder:
+    """Mirror QEMU stderr to our stderr from the selector loop and watch for READY_MSG."""
+
+    def __init__(self, sel: selectors.BaseSelector, stream) -> None:
+        self.sel = sel
+        self.fd = stream.fileno()
+        self.ready = False
+        self.closed = False
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._tail = ""
+        sel.register(self.fd, selectors.EVENT_READ, self)
+
+    def read(self) -> None:
+        data = os.read(self.fd, 65536)
+        if not data:
+            self.sel.unregister(self.fd)
+            self.closed = True
+            return
+        text = self._decoder.decode(data, final=False)
+        sys.stderr.write(text)
+        # READY_MSG 可能跨两次 read，保留上一块的尾部一起匹配
+        window = self._tail + text
+        if READY_MSG in window:
+            self.ready = True
+        self._tail = window[-len(READY_MSG) :]
+
+
+class SerialMirror:
+    """Tee serial output to a text stream's binary buffer, batching writes.
 
+    Data is flushed once MIRROR_FLUSH_SIZE bytes are pending or MIRROR_FLUSH_INTERVAL
+    has passed, and whenever the caller reaches a prompt/exit marker or goes idle.
+    """
 
-def read_stderr(proc: subprocess.Popen, ready_event: threading.Event) -> None:
+    def __init__(self, stream) -> None:
+        self.stream = stream
+        self._pending = bytearray()
+        self._last_flush = time.monotonic()
+
+    def __call__(self, data: bytes) -> None:
+        self._pending += data
+        if (
+            len(self._pending) >= MIRROR_FLUSH_SIZE
+            or time.monotonic() - self._last_flush >= MIRROR_FLUSH_INTERVAL
+        ):
+            self.flush()
+
+    def flush(self) -> None:
+        self._last_flush = time.monotonic()
+        if not self._pending:
+            return
+        # 先刷新文本层，保证与 log()/print 的输出顺序一致
+        self.stream.flush()
+        self.stream.buffer.write(self._pending)
+        self.stream.buffer.flush()
+        self._pending.clear()
+
+
+def kill_group(proc: subprocess.Popen, sig: int) -> None:
+    """Signal make and everything it spawned (QEMU) via the process group."""
     try:
-        for line in proc.stderr:
-            sys.stderr.write(line)
-            if READY_MSG in line:
-                ready_event.set()
-    finally:
-        ready_event.set()
+        os.killpg(proc.pid, sig)
+    except ProcessLookupError:
+        pass
 
 
-def connect(port: int, retries: int, delay: float) -> socket.socket:
-    last_err = None
-    for _ in range(retries):
-        try:
-            return socket.create_connection(("localhost", port), timeout=5)
-        except OSError as err:
-            last_err = err
-            time.sleep(delay)
-    raise last_err if last_err else RuntimeError("unable to connect")
+def raise_exit(signum, _frame) -> None:
+    """Turn SIGTERM/SIGHUP into SystemExit so run()'s finally still tears down QEMU."""
+    raise SystemExit(128 + signum)
+
+
+def wait_draining(proc: subprocess.Popen, sel: selectors.BaseSelector, stderr: StderrForwarder, timeout: float) -> bool:
+    """Wait for proc to exit while still draining its stderr pipe."""
+    deadline = time.monotonic() + timeout
+    while proc.poll() is None:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        for key, _ in sel.select(timeout=min(remaining, 0.1)):
+            if key.data is stderr:
+                stderr.read()
+    return True
+
+
+@functools.lru_cache(maxsize=None)
+def resolve(port: int):
+    return socket.getaddrinfo("localhost", port, socket.AF_INET, socket.SOCK_STREAM)[0]
+
+
+def connect(port: int) -> socket.socket:
+    """Make one connection attempt to the QEMU serial port; retries are driven by run()."""
+    family, socktype, proto, _, addr = resolve(port)
+    sock = socket.socket(family, socktype, proto)
+    # 接收缓冲需在握手前设置，TCP 窗口缩放因子在 connect 时协商
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCK_RCVBUF)
+    sock.settimeout(5)
+    try:
+        sock.connect(addr)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+@functools.lru_cache(maxsize=32)
+def strip_pattern(command: str, full_command: str) -> "re.Pattern[str]":
+    # full_command 以 command 开头，放在前面优先匹配
+    tokens = [t for t in (full_command, command, PROMPT) if t]
+    return re.compile("|".join(re.escape(t) for t in tokens))
 
 
 def sanitize_output(raw: str, command: str, full_command: str) -> str:
     text = raw.replace("\r", "")
-    for token in (full_command, command, PROMPT):
-        if token:
-            text = text.replace(token, "")
-    text = text.strip()
-    if "__EXIT:" in text:
-        text = EXIT_PATTERN.split(text)[0].strip()
+    text = strip_pattern(command or "", full_command or "").sub("", text).strip()
+    match = EXIT_PATTERN.search(text)
+    if match:
+        text = text[: match.start()].strip()
     if not text:
         return ""
 
@@ -64,6 +170,158 @@ def sanitize_output(raw: str, command: str, full_command: str) -> str:
     return text
 
 
+def recv_serial(sock: socket.socket, sel: selectors.BaseSelector, stderr: StderrForwarder) -> Optional[bytes]:
+    """Wait briefly for serial data while draining QEMU stderr.
+
+    Returns None if nothing arrived, b"" once the connection is closed.
+    """
+    sock_ready = False
+    for key, _ in sel.select(timeout=POLL_INTERVAL):
+        if key.data is stderr:
+            stderr.read()
+        elif key.fileobj is sock:
+            sock_ready = True
+    if not sock_ready:
+        return None
+    try:
+        return sock.recv(RECV_SIZE)
+    except BlockingIOError:
+        return None
+
+
+def wait_prompt(
+    sock: socket.socket,
+    sel: selectors.BaseSelector,
+    stderr: StderrForwarder,
+    mirror: SerialMirror,
+) -> bool:
+    buffer = bytearray()
+    scan = 0
+    while True:
+        data = recv_serial(sock, sel, stderr)
+        if data is None:
+            mirror.flush()
+            continue
+        if not data:
+            mirror.flush()
+            return False
+        mirror(data)
+        buffer += data
+        if buffer.find(PROMPT_BYTES, scan) != -1:
+            mirror.flush()
+            return True
+        scan = max(0, len(buffer) - len(PROMPT_BYTES) + 1)
+
+
+def exec_command(
+    sock: socket.socket,
+    sel: selectors.BaseSelector,
+    stderr: StderrForwarder,
+    mirror: SerialMirror,
+    command: str,
+    timeout: float,
+    until_prompt: bool = False,
+) -> Optional[Tuple[int, str]]:
+    """Run one shell command and return (exit_code, payload), or None if the connection closed.
+
+    With until_prompt, also consume the prompt printed after the exit marker so the
+    next command starts from a clean stream.
+    """
+    full_command = f"{command}; echo __EXIT:$?__"
+    sock.sendall(full_command.encode("utf-8") + b"\n")
+    start = time.monotonic()
+    buffer = bytearray()
+    exit_scan = 0
+    match = None
+    while True:
+        data = recv_serial(sock, sel, stderr)
+        if data == b"":
+            mirror.flush()
+            return None
+        if data is None:
+            mirror.flush()
+        else:
+            mirror(data)
+            buffer += data
+            if match is None:
+                match = EXIT_PATTERN_BYTES.search(buffer, exit_scan)
+                exit_scan = max(0, len(buffer) - EXIT_RESCAN)
+            if match is not None and (not until_prompt or buffer.find(PROMPT_BYTES, match.end()) != -1):
+                break
+        if time.monotonic() - start > timeout:
+            raise RuntimeError("command timed out")
+
+    mirror.flush()
+    text = buffer.decode("utf-8", errors="replace")
+    return int(match.group(1)), sanitize_output(text, command, full_command)
+
+
+def serve(
+    sock: socket.socket,
+    sel: selectors.BaseSelector,
+    stderr: StderrForwarder,
+    mirror: SerialMirror,
+    timeout: float,
+) -> None:
+    """Execute commands read line by line from stdin against the booted shell.
+
+    Each result is written to stdout as one JSON line: {"command", "exit_code", "payload"},
+    or {"command", "error"} if the command failed, after which the session ends.
+    """
+
+    def emit(result: dict) -> None:
+        print(json.dumps(result, ensure_ascii=False), flush=True)
+
+    stdin_fd = sys.stdin.fileno()
+    pending = bytearray()
+    eof = False
+    while True:
+        nl = pending.find(b"\n")
+        if nl != -1 or (eof and pending):
+            end = nl if nl != -1 else len(pending)
+            command = pending[:end].decode("utf-8", errors="replace").strip()
+            del pending[: end + 1]
+            if not command:
+                continue
+            try:
+                result = exec_command(sock, sel, stderr, mirror, command, timeout, until_prompt=True)
+                if result is None:
+                    raise RuntimeError("serial connection closed")
+            except (RuntimeError, OSError) as err:
+                emit({"command": command, "error": str(err)})
+                raise
+            exit_code, payload = result
+            emit({"command": command, "exit_code": exit_code, "payload": payload})
+            continue
+        if eof:
+            return
+
+        # 空闲等待下一条命令时同样排空 QEMU stderr 与串口，避免管道写满或旧输出混入下一条命令。
+        # stdin 只在空闲时注册，执行命令期间不参与 select
+        sel.register(stdin_fd, selectors.EVENT_READ)
+        try:
+            for key, _ in sel.select(timeout=POLL_INTERVAL):
+                if key.data is stderr:
+                    stderr.read()
+                elif key.fileobj is sock:
+                    try:
+                        data = sock.recv(RECV_SIZE)
+                    except BlockingIOError:
+                        continue
+                    if not data:
+                        raise RuntimeError("serial connection closed")
+                    mirror(data)
+                else:
+                    data = os.read(stdin_fd, 65536)
+                    if data:
+                        pending += data
+                    else:
+                        eof = True
+        finally:
+            sel.unregister(stdin_fd)
+        mirror.flush()
+
+
 def run(args):
     root = Path(args.root).resolve()
     if not root.is_dir():
@@ -89,22 +347,31 @@ def run(args):
     proc = subprocess.Popen(
         cmd,
         cwd=root,
+        # --server 模式下 stdin 承载命令协议，不能让 make/QEMU 继承并读走
+        stdin=subprocess.DEVNULL if args.server else None,
         stderr=subprocess.PIPE,
-        text=True,
         env=env,
+        start_new_session=True,
     )
-    ready = threading.Event()
-    thread = threading.Thread(target=read_stderr, args=(proc, ready), daemon=True)
-    thread.start()
+    # 单线程事件循环同时处理 QEMU stderr 与串口 socket
+    sel = selectors.DefaultSelector()
+    stderr = StderrForwarder(sel, proc.stderr)
 
     exit_code = 0
     payload = None
     command = args.command
-    full_command = f"{command}; echo __EXIT:$?__" if command else None
+    # 执行命令时 stdout 留给结果输出，串口内容回显到 stderr
+    mirror = SerialMirror(sys.stderr if command or args.server else sys.stdout)
 
     try:
-        if not ready.wait(timeout=args.boot_timeout):
-            raise RuntimeError("QEMU did not signal readiness")
+        boot_deadline = time.monotonic() + args.boot_timeout
+        while not stderr.ready and not stderr.closed:
+            remaining = boot_deadline - time.monotonic()
+            if remaining <= 0:
+                raise RuntimeError("QEMU did not signal readiness")
+            for key, _ in sel.select(timeout=min(remaining, 0.5)):
+                if key.data is stderr:
+                    stderr.read()
         if proc.poll() is not None:
             raise RuntimeError("QEMU exited prematurely")
 
@@ -112,80 +379,45 @@ def run(args):
         completed = False
         last_err = None
         while attempt < args.retries and not completed:
+            # 连接失败与会话中断共用同一个由 --retries 限定的退避循环
+            if attempt:
+                time.sleep(min(CONNECT_BACKOFF * 2 ** (attempt - 1), CONNECT_BACKOFF_MAX))
             try:
-                sock = connect(args.port, retries=1, delay=1)
-                sock.settimeout(2)
+                sock = connect(args.port)
+                sock.setblocking(False)
             except OSError as err:
                 last_err = err
                 attempt += 1
-                time.sleep(1)
                 continue
 
+            sel.register(sock, selectors.EVENT_READ)
             try:
-                buffer = ""
-                command_buffer = ""
-                prompt_seen = False
-                command_sent = False
-                command_start = None
-                decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
-
-                while True:
-                    try:
-                        data = sock.recv(1024)
-                    except socket.timeout:
-                        if prompt_seen and not command_sent:
-                            break
-                        if command_sent and command_start is not None:
-                            if time.monotonic() - command_start > args.command_timeout:
-                                raise RuntimeError("command timed out")
-                        continue
-
-                    if not data:
-                        break
+                if not wait_prompt(sock, sel, stderr, mirror):
+                    attempt += 1
+                    continue
 
-                    chunk = decoder.decode(data, final=False)
-                    if command:
-                        sys.stderr.write(chunk)
-                    else:
-                        print(chunk, end="")
-
-                    buffer += chunk
-
-                    if not prompt_seen and PROMPT in buffer:
-                        prompt_seen = True
-                        if command:
-                            log("shell prompt detected, executing command")
-                            sock.sendall(full_command.encode("utf-8") + b"\n")
-                            command_sent = True
-                            command_start = time.monotonic()
-                            command_buffer = ""
-                            buffer = ""
-                        else:
-                            log("shell prompt detected, sending exit")
-                            sock.sendall(b"exit\n")
-                            completed = True
-                            break
-
-                    if command_sent:
-                        command_buffer += chunk
-                        match = EXIT_PATTERN.search(command_buffer)
-                        if match:
-                            exit_code = int(match.group(1))
-                            payload = sanitize_output(command_buffer, command, full_command)
-                            log(f"command completed with exit code {exit_code}")
-                            sock.sendall(b"exit\n")
-                            completed = True
-                            break
-                        if command_start is not None and (time.monotonic() - command_start) > args.command_timeout:
-                            raise RuntimeError("command timed out")
-                if completed:
-                    break
+                if args.server:
+                    log("shell prompt detected, entering server mode")
+                    serve(sock, sel, stderr, mirror, args.command_timeout)
+                elif command:
+                    log("shell prompt detected, executing command")
+                    result = exec_command(sock, sel, stderr, mirror, command, args.command_timeout)
+                    if result is None:
+                        attempt += 1
+                        continue
+                    exit_code, payload = result
+                    log(f"command completed with exit code {exit_code}")
+                else:
+                    log("shell prompt detected, sending exit")
+                sock.sendall(b"exit\n")
+                completed = True
             finally:
+                mirror.flush()
+                sel.unregister(sock)
                 try:
                     sock.close()
                 except OSError:
                     pass
-            attempt += 1
 
         if command:
             if payload is None:
@@ -196,15 +428,14 @@ def run(args):
         log("BusyBox shell exited cleanly")
         return exit_code, payload
     finally:
-        try:
-            proc.wait(timeout=5)
-        except subprocess.TimeoutExpired:
-            proc.terminate()
-            try:
-                proc.wait(timeout=5)
-            except subprocess.TimeoutExpired:
-                proc.kill()
+        if not wait_draining(proc, sel, stderr, timeout=5):
+            kill_group(proc, signal.SIGTERM)
+            if not wait_draining(proc, sel, stderr, timeout=3):
+                kill_group(proc, signal.SIGKILL)
                 proc.wait(timeout=5)
+        # make 退出后 QEMU 可能仍存活并占用串口端口，连同整个进程组一起清理
+        kill_group(proc, signal.SIGKILL)
+        sel.close()
 
 
 if __name__ == "__main__":
@@ -216,7 +447,21 @@ if __name__ == "__main__":
     parser.add_argument("--retries", type=int, default=5)
     parser.add_argument("--command", help="Shell command to execute once the prompt is ready")
     parser.add_argument("--command-timeout", type=int, default=600)
+    parser.add_argument(
+        "--server",
+        action="store_true",
+        help="Keep the VM booted and run commands read from stdin, one JSON result line per command on stdout",
+    )
     args = parser.parse_args()
+    if args.server and args.command:
+        parser.error("--server and --command are mutually exclusive")
+    if args.server:
+        # stdout 只输出 JSON 结果行
+        LOG_FILE = sys.stderr
+
+    # QEMU 在独立进程组中，CI 取消/timeout 发给本进程组的信号到不了它，必须经 finally 清理
+    for sig in (signal.SIGTERM, signal.SIGHUP):
+        signal.signal(sig, raise_exit)
 
     try:
         exit_code, payload = run(args)